@@ -1,47 +1,122 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
+import orjson
 from datetime import datetime
-import xml.etree.ElementTree as ET
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import time
 import logging # エラーログ用に追加
 
+try:
+    from lxml import etree
+    _HAS_LXML = True
+    _XML_PARSE_ERROR = etree.XMLSyntaxError
+except ImportError:
+    # lxml未導入でも標準ライブラリのiterparseで同じストリーミング処理ができる
+    # (C実装ほど速くはないが、全ツリーを構築しない点は同じ)
+    import xml.etree.ElementTree as etree
+    _HAS_LXML = False
+    _XML_PARSE_ERROR = etree.ParseError
+
 # --- 定数 ---
 PRIMARY_AREA_URL = "https://weather.tsukumijima.net/primary_area.xml"
 WEATHER_API_URL_BASE = "https://weather.tsukumijima.net/api/forecast/city/"
 DEFAULT_PREF = "東京都"
 DEFAULT_CITY = "東京"
-CACHE_TTL = 3600 # キャッシュ有効期間（秒）
+DEFAULT_CITY_CODE = "130010" # 東京。初回ロード時の先読みに使う
+CACHE_TTL = 3600 # 地点情報キャッシュ有効期間（秒）
+WEATHER_CACHE_TTL = 600 # 天気予報キャッシュ有効期間（秒）
+SLOT_KEYS = ('T00_06', 'T06_12', 'T12_18', 'T18_24') # 降水確率の6時間刻みスロット
+COL_LABELS = ('0-6時', '6-12時', '12-18時', '18-24時')
+INDEX_LABELS = ('今日', '明日', '明後日')
+_SLOT_GET = itemgetter(*SLOT_KEYS) # 4スロットをC実装1回で取り出す
+
+def _rain_row(chance_of_rain):
+    """1日分のchanceOfRain dictから4スロット分の降水確率を取り出す"""
+    if not chance_of_rain:
+        return ('--',) * 4
+    try:
+        return _SLOT_GET(chance_of_rain) # 整形済みペイロードはこの高速パスで済む
+    except KeyError:
+        return tuple(chance_of_rain.get(k, '--') for k in SLOT_KEYS)
 
 # --- ロギング設定 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# --- HTTPセッション (接続を再利用してTCP+TLSハンドシェイクを省く) ---
+@st.cache_resource
+def _session():
+    """全セッションで共有するHTTPセッションを返す（cache_resourceなのでコピーされずシングルトン）"""
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    # XMLはタグの繰り返しが多く圧縮が効くので、圧縮転送を明示しておく（展開はrequestsが透過的に行う）
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'User-Agent': 'tech0-weather/1.0'})
+    return session
+
 # --- データ取得関数 (キャッシュ付き) ---
 @st.cache_data(ttl=CACHE_TTL)
 def get_location_data_from_xml():
-    """地点定義XMLを取得してパースし、JSONライクな構造に変換する"""
+    """地点定義XMLをストリーミング取得し、{都道府県名: {地域名: 地域ID}} の辞書に変換する"""
     try:
-        response = requests.get(PRIMARY_AREA_URL, timeout=10) # タイムアウト追加
+        response = _session().get(PRIMARY_AREA_URL, stream=True, timeout=10) # タイムアウト追加
         response.raise_for_status()
-        response.encoding = response.apparent_encoding
-        root = ET.fromstring(response.text)
+        response.raw.decode_content = True # gzip等を透過的に展開してパーサへ渡す
 
-        location_list = []
-        for pref_elem in root.findall('.//pref'):
+        # iterparseでpref要素ごとに処理し、処理済み要素は都度解放してピークメモリを抑える
+        # 外部フィードなのでlxmlではエンティティ展開・外部アクセスを無効化しておく
+        if _HAS_LXML:
+            pref_iter = etree.iterparse(
+                response.raw, tag='pref',
+                huge_tree=False, resolve_entities=False, no_network=True,
+            )
+        else:
+            pref_iter = (
+                (event, elem)
+                for event, elem in etree.iterparse(response.raw, events=('end',))
+                if elem.tag == 'pref'
+            )
+
+        # dict-of-dictsにしておくと、rerunごとの都道府県・地域の解決がO(1)になる
+        location_map = {}
+        for _, pref_elem in pref_iter:
             pref_name = pref_elem.get('title')
-            if not pref_name: continue
+            if pref_name:
+                cities_map = {}
+                for city_elem in pref_elem.iter('city'):
+                    city_id = city_elem.get('id')
+                    city_name = city_elem.get('title')
+                    if city_id and city_name:
+                        cities_map[city_name] = city_id
+
+                if cities_map:
+                    location_map[pref_name] = cities_map
 
-            cities_list = []
-            for city_elem in pref_elem.findall('./city'):
-                city_id = city_elem.get('id')
-                city_name = city_elem.get('title')
-                if city_id and city_name:
-                    cities_list.append({'id': city_id, 'name': city_name})
+            pref_elem.clear()
+            if _HAS_LXML:
+                while pref_elem.getprevious() is not None:
+                    del pref_elem.getparent()[0]
 
-            if cities_list:
-                location_list.append({'name': pref_name, 'cities': cities_list})
+        prefecture_list = list(location_map.keys())
+
+        # デフォルト選択のインデックスはキャッシュ内で一度だけ解決しておく
+        if DEFAULT_PREF in location_map:
+            default_pref_index = prefecture_list.index(DEFAULT_PREF)
+            default_cities = list(location_map[DEFAULT_PREF])
+            if DEFAULT_CITY in location_map[DEFAULT_PREF]:
+                default_city_index = default_cities.index(DEFAULT_CITY)
+            else:
+                logging.warning(f"'{DEFAULT_PREF}' 内のデフォルト地域 '{DEFAULT_CITY}' が見つかりません。リストの先頭を使用します。")
+                default_city_index = 0
+        else:
+            logging.warning(f"デフォルト都道府県 '{DEFAULT_PREF}' が見つかりません。リストの先頭を使用します。")
+            default_pref_index = 0
+            default_city_index = 0
 
         logging.info("地点情報を正常に取得・パースしました。")
-        return location_list
+        return prefecture_list, location_map, default_pref_index, default_city_index
 
     except requests.exceptions.Timeout:
         logging.error(f"地点情報の取得がタイムアウトしました: {PRIMARY_AREA_URL}")
@@ -51,7 +126,7 @@ def get_location_data_from_xml():
         logging.error(f"地点情報の取得に失敗しました: {e}")
         st.error(f"地点情報の取得に失敗しました: {e}")
         return None
-    except ET.ParseError as e:
+    except _XML_PARSE_ERROR as e:
         logging.error(f"地点情報のXMLパースに失敗しました: {e}")
         st.error(f"地点情報のXMLパースに失敗しました。")
         return None
@@ -60,14 +135,24 @@ def get_location_data_from_xml():
         st.error(f"地点情報の処理中に予期せぬエラーが発生しました。")
         return None
 
+@lru_cache(maxsize=64)
+def _cached_forecast_bytes(city_code, ttl_bucket):
+    """天気予報APIの生レスポンスを取得する。ttl_bucketが変わるとキャッシュミスになり、
+    失敗した呼び出しはlru_cacheに残らない（cache_dataのような戻り値コピーも発生しない）"""
+    url = f"{WEATHER_API_URL_BASE}{city_code}"
+    response = _session().get(url, timeout=10)
+    response.raise_for_status()
+    logging.info(f"天気予報を正常に取得しました: city_code={city_code}")
+    return response.content
+
 def get_weather_forecast(city_code):
     """指定されたcity_codeの天気予報を取得する"""
     url = f"{WEATHER_API_URL_BASE}{city_code}"
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        logging.info(f"天気予報を正常に取得しました: city_code={city_code}")
-        return response.json()
+        # 時刻をWEATHER_CACHE_TTL秒刻みのバケットに丸めてTTL付きキャッシュとして使う
+        ttl_bucket = int(time.time() // WEATHER_CACHE_TTL)
+        # orjsonはbytesを直接受け取るので、response.textのデコードを経由しない
+        return orjson.loads(_cached_forecast_bytes(city_code, ttl_bucket))
     except requests.exceptions.Timeout:
         logging.error(f"天気予報の取得がタイムアウトしました: {url}")
         st.error("天気予報の取得がタイムアウトしました。しばらくしてから再試行してください。")
@@ -81,64 +166,62 @@ def get_weather_forecast(city_code):
         st.error(f"天気予報の処理中に予期せぬエラーが発生しました。")
         return None
 
+def _reset_city_selection():
+    """都道府県変更時に地域選択をデフォルトへ戻す（ウィジェットを作り直さず状態だけリセットする）"""
+    st.session_state.pop('city_selectbox', None)
+
 # --- Streamlit アプリケーション ---
 def main():
     st.set_page_config(page_title="天気アプリ", layout="wide") # ページ設定
     st.title("天気アプリ")
     st.write("調べたい地域を選んでください。")
 
-    location_data = get_location_data_from_xml()
+    # 地点XMLとデフォルト地域(東京)の予報は独立したGETなので並行して取得し、
+    # 初回ロードからRTT1回分を省く（キャッシュ命中時はどちらも即時に返る）
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        location_future = executor.submit(get_location_data_from_xml)
+        default_weather_future = executor.submit(get_weather_forecast, DEFAULT_CITY_CODE)
+        location_data = location_future.result()
 
     if not location_data:
         st.error("アプリケーションを初期化できません。地点情報を取得できませんでした。")
         return # 地点情報がなければ処理中断
 
-    prefecture_list = [pref['name'] for pref in location_data]
-
-    try:
-        default_pref_index = prefecture_list.index(DEFAULT_PREF)
-    except ValueError:
-        logging.warning(f"デフォルト都道府県 '{DEFAULT_PREF}' が見つかりません。リストの先頭を使用します。")
-        default_pref_index = 0
+    prefecture_list, location_map, default_pref_index, default_city_index_for_pref = location_data
 
     selected_prefecture_name = st.selectbox(
         "都道府県を選んでください。",
         prefecture_list,
-        index=default_pref_index
+        index=default_pref_index,
+        key="pref_selectbox",
+        on_change=_reset_city_selection
     )
 
-    selected_cities = []
-    city_list = []
+    city_options = []
     default_city_index = 0
 
     if selected_prefecture_name:
-        for pref_data in location_data:
-            if pref_data['name'] == selected_prefecture_name:
-                selected_cities = pref_data['cities']
-                city_list = [city['name'] for city in selected_cities]
-                if selected_prefecture_name == DEFAULT_PREF:
-                    try:
-                        default_city_index = city_list.index(DEFAULT_CITY)
-                    except ValueError:
-                        logging.warning(f"'{selected_prefecture_name}' 内のデフォルト地域 '{DEFAULT_CITY}' が見つかりません。リストの先頭を使用します。")
-                        default_city_index = 0
-                else:
-                    default_city_index = 0
-                break
-
-    selected_city_name = st.selectbox(
+        # 派生リストはsession_stateに都道府県名キーで持ち、rerunごとの再構築を避ける
+        # (都道府県は~47件なのでメモリ上限も自明に有界)
+        cache_key = f'_city_options::{selected_prefecture_name}'
+        if cache_key not in st.session_state:
+            st.session_state[cache_key] = list(location_map.get(selected_prefecture_name, {}).items())
+        city_options = st.session_state[cache_key]
+        if selected_prefecture_name == DEFAULT_PREF:
+            default_city_index = default_city_index_for_pref
+
+    # 選択肢を(地域名, 地域ID)のタプルで持てば、選択値からIDへの逆引きが不要になる。
+    # キーを固定することでウィジェットの破棄・再生成（全選択肢の再送信）を避ける。
+    # 都道府県変更時のリセットはon_changeコールバック側で行う
+    selected_city = st.selectbox(
         "地域を選んでください。",
-        city_list,
+        city_options,
         index=default_city_index,
-        key=f"city_selectbox_{selected_prefecture_name}" # 都道府県変更時のリセット用キー
+        format_func=itemgetter(0), # 表示は地域名のみ
+        key="city_selectbox"
     )
 
-    city_code = None
-    if selected_city_name and selected_cities:
-        for city_data in selected_cities:
-            if city_data['name'] == selected_city_name:
-                city_code = city_data['id']
-                break
+    selected_city_name, city_code = selected_city if selected_city else (None, None)
 
     if not city_code:
         st.warning("地域を選択してください、または選択した地域のコードが見つかりません。")
@@ -147,7 +230,11 @@ def main():
     st.write(f"**選択中の地域:** {selected_prefecture_name} - {selected_city_name} (コード: {city_code})")
     st.divider() # 区切り線
 
-    weather_json = get_weather_forecast(city_code)
+    # デフォルト地域なら先読み結果をそのまま使い、3回目の呼び出しを避ける
+    if city_code == DEFAULT_CITY_CODE:
+        weather_json = default_weather_future.result()
+    else:
+        weather_json = get_weather_forecast(city_code)
 
     if not weather_json:
         # get_weather_forecast内でエラー表示済みなのでここでは何もしないか、追加メッセージ
@@ -157,54 +244,26 @@ def main():
     # --- 現在の降水確率表示 ---
     st.subheader("現在の降水確率")
     now_hour = datetime.now().hour
-    weather_now = '--'
     forecast_today = weather_json.get('forecasts', [{}])[0] # 今日の予報を安全に取得
     chance_of_rain_today = forecast_today.get('chanceOfRain')
 
-    if chance_of_rain_today: # Noneでないことを確認
-        time_slots = {'T00_06': (0, 6), 'T06_12': (6, 12), 'T12_18': (12, 18), 'T18_24': (18, 24)}
-        found_slot = False
-        for key, (start, end) in time_slots.items():
-            # now_hourが24時以降になることは通常ないが、ロジックとして18-24に含める
-            current_hour_in_slot = (start <= now_hour < end) or (key == 'T18_24' and now_hour >= end)
-            if current_hour_in_slot:
-                weather_now = chance_of_rain_today.get(key, '--')
-                found_slot = True
-                break
-        # どのスロットにも当てはまらない場合（通常ありえないが念のため）
-        if not found_slot and now_hour >= 0:
-             weather_now = chance_of_rain_today.get('T18_24', '--') # フォールバックとして最後の時間帯
+    # スロットは一様な6時間刻みなので、整数除算で直接インデックスできる（分岐不要）
+    slot_idx = min(now_hour // 6, 3)
+    weather_now = chance_of_rain_today.get(SLOT_KEYS[slot_idx], '--') if chance_of_rain_today else '--'
 
     st.metric(label="現在時刻の含まれる時間帯", value=f"{weather_now}")
     st.divider() # 区切り線
 
     # --- 3日間の降水確率DataFrame表示 ---
     st.subheader("時間帯別 降水確率")
-    data = []
-    index_labels = ["今日", "明日", "明後日"]
-    forecasts = weather_json.get('forecasts', [])
-    days_to_show = min(len(forecasts), 3)
-
-    for i in range(days_to_show):
-        forecast = forecasts[i]
-        chance_of_rain = forecast.get('chanceOfRain')
-        if chance_of_rain:
-            rain_probabilities = [
-                chance_of_rain.get('T00_06', '--'),
-                chance_of_rain.get('T06_12', '--'),
-                chance_of_rain.get('T12_18', '--'),
-                chance_of_rain.get('T18_24', '--')
-            ]
-            data.append(rain_probabilities)
-        else:
-            logging.warning(f"{index_labels[i]} の降水確率データ(chanceOfRain)が見つかりません。city_code={city_code}")
-            data.append(['--'] * 4)
+    forecasts = weather_json.get('forecasts', [])[:3]
 
-    if data:
+    if forecasts:
+        rows = [_rain_row(f.get('chanceOfRain')) for f in forecasts]
         df = pd.DataFrame(
-            data,
-            index=index_labels[:days_to_show],
-            columns=['0-6時', '6-12時', '12-18時', '18-24時']
+            rows,
+            index=list(INDEX_LABELS[:len(forecasts)]),
+            columns=list(COL_LABELS)
         )
         st.dataframe(df, use_container_width=True) # コンテナ幅に合わせる
     else: